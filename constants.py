@@ -1,3 +1,4 @@
+import os
 from datetime import timedelta
 from enum import Flag
 
@@ -12,6 +13,15 @@ class State(Flag):
     OFF = False
 
 
+# --- Data Files ---
+# Files to log sensor and effector data to
+DATA_FOLDER = "data"
+SENSOR_DATA_FILEPATH = os.path.join(DATA_FOLDER, "sensor_values.csv")
+EFFECTOR_DATA_FILEPATH = os.path.join(DATA_FOLDER, "effector_states.csv")
+EFFECTOR_USAGE_FILEPATH = os.path.join(DATA_FOLDER, "effector_usage.json")
+EFFECTOR_USAGE_HISTORY_FILEPATH = os.path.join(
+    DATA_FOLDER, "effector_usage_history.csv")
+
 # --- Sensor Values ---
 AIR_O2_MIN = 15     # Minimum O2 % of system air
 AIR_O2_NORM = 18    # Normal O2 % of system air
@@ -36,6 +46,15 @@ RADIATOR_VALVE_ON_INTERVAL = BLOWER_ON_INTERVAL + VALVE_BUFFER_INTERVAL
 MAX_WAIT_HANDSHAKE = timedelta(seconds=10)
 
 UPLOAD_INTERVAL_SECONDS = timedelta(seconds=900)
+SENSOR_READING_INTERVAL = timedelta(seconds=3)  # Rate at which the MCU sends sensor data
+SENSOR_HISTORY_DURATION = timedelta(hours=6)    # Readings kept in memory for trend queries
+
+# Estimated electrical power draw of each effector in watts, used for energy
+# accounting. Adjust to the installed hardware.
+BLOWER_POWER_W = 60
+WATER_PUMP_POWER_W = 12
+RADIATOR_VALVE_POWER_W = 5
+AIR_RENEW_VALVE_POWER_W = 5
 
 # Serial out messages. See 'MSG_TO_TEXT' for explanation.
 BLOWER_ON_MSG = 'a'.encode()
@@ -48,6 +67,12 @@ WATER_PUMP_ON_MSG = 'g'.encode()
 WATER_PUMP_OFF_MSG = 'h'.encode()
 
 RUN_ALL_EFFECTORS = 'j'.encode()
+
+# Several of the messages above can be sent in a single frame:
+# BATCH_MSG_HEADER, the messages, then BATCH_MSG_END. The MCU acknowledges
+# the whole frame with one line: 'k' followed by the messages applied.
+BATCH_MSG_HEADER = 'k'.encode()
+BATCH_MSG_END = '\n'.encode()
 # REMINDER: message 'i' cannot be used as it is the sensor info HEADER!
 
 MSG_TO_TEXT = {
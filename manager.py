@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 import serial
 import csv
+import json
 import os
 import logging
 import git
 import pytz
+import queue
+import collections
+import signal
+import time
+import sys
+import multiprocessing
+from array import array
 from threading import Thread
-from datetime import datetime, timezone, timedelta
+from datetime import date, datetime, timezone, timedelta
 from constants import *
 
 format = "%(asctime)s: %(levelname)s: %(message)s"
@@ -15,16 +23,36 @@ logging.basicConfig(format=format, level=logging.INFO, datefmt="%H:%M:%S")
 # Runtime constants
 TEST_ALL_SYSTEMS = False
 UPDATE_EFFECTORS_STATES = True
+# Send all state changes of a control tick in one frame. Disable for MCU
+# firmware that only understands single-byte messages.
+BATCH_EFFECTOR_MSGS = True
+# Fall back to single-byte messages after this many consecutive batched
+# frames go unacknowledged, unless the MCU has acknowledged one before.
+MAX_UNACKNOWLEDGED_FRAMES = 3
 
 IS_SOIL_H2O_SENSOR_ENABLED = True
 
 SERIAL_NAME = '/dev/ttyACM0'
 BAUD_RATE = 9600
 
-# Files to log sensor and effector data to
-DATA_FOLDER = "data"
-SENSOR_DATA_FILEPATH = os.path.join(DATA_FOLDER, "sensor_values.csv")
-EFFECTOR_DATA_FILEPATH = os.path.join(DATA_FOLDER, "effector_states.csv")
+# Maximum number of log rows waiting to be written by the writer process.
+# Rows submitted while the queue is full are dropped, never waited on.
+LOG_QUEUE_MAXSIZE = 1000
+LOG_QUEUE_POLL_INTERVAL = timedelta(seconds=1)
+LOG_QUEUE_REPORT_INTERVAL = timedelta(minutes=1)
+LOG_WRITER_SUPERVISE_INTERVAL = timedelta(seconds=5)
+# Interval at which effector usage records that the manager is still alive
+USAGE_HEARTBEAT_INTERVAL = timedelta(minutes=1)
+LOG_WRITER_STOP_TIMEOUT = timedelta(seconds=10)
+
+# The writer process is spawned rather than forked: forking a process that
+# runs other threads can leave the child holding locks it will never get.
+LOG_WRITER_CONTEXT = multiprocessing.get_context("spawn")
+
+# Number of readings kept per sensor in the in-memory history
+SENSOR_HISTORY_CAPACITY = int(SENSOR_HISTORY_DURATION / SENSOR_READING_INTERVAL)
+# Readings further apart than this leave a hole in the history
+SENSOR_HISTORY_MAX_GAP = 3 * SENSOR_READING_INTERVAL
 
 # SENSOR_FIELDS maps field name to position for
 # sensor messages coming from the Arduino
@@ -36,9 +64,18 @@ SENSOR_FIELDS = {
     "system_air_temperature": 7,
 }
 
+# Columns of the history of daily effector usage
+USAGE_HISTORY_COLUMNS = ["day", "effector", "on_seconds",
+                         "switch_count", "energy_wh"]
+
+# Kinds of records handed to the log writer process
+RECORD_ROW = "row"            # A row appended to a CSV file
+RECORD_SNAPSHOT = "snapshot"  # The full content of a file, replacing it
+
 # Message headers
 HEADER_SENSOR_DATA = "i"
 HEADER_LOG_DATA = "j"
+HEADER_BATCH_HANDSHAKE = "k"
 
 
 class Handshake():
@@ -47,9 +84,11 @@ class Handshake():
     the manager expects to receive a confirmation handshake.
     """
 
-    def __init__(self, timestamp, out_msg):
+    def __init__(self, timestamp, out_msg, frame=None):
         self.timestamp = timestamp
         self.out_msg = out_msg
+        # Number of the batched frame the message was sent in, if any
+        self.frame = frame
 
     def __repr__(self):
         return f"{self.out_msg}"
@@ -62,7 +101,8 @@ class Effector():
 
     def __init__(self, prev_time=None,
                  curr_state=State.OFF, on_msg=None, off_msg=None,
-                 on_interval=None, off_interval=None, name=None):
+                 on_interval=None, off_interval=None, name=None,
+                 power_watts=0):
         # Current state is the inverse of the last state
         self.curr_state: bool = curr_state
         self.next_state: State = curr_state
@@ -72,6 +112,7 @@ class Effector():
         self.on_msg: bytes = on_msg
         self.off_msg: bytes = off_msg
         self.prev_time: datetime = prev_time
+        self.power_watts: float = power_watts
 
     def __repr__(self):
         return f"{self.name}"
@@ -103,19 +144,186 @@ class Effector():
             self.prev_time = datetime.now()
 
 
+class EffectorUsage():
+    """
+    EffectorUsage keeps the on-time, switch count and estimated energy of
+    every effector for the current UTC day, updated when the MCU confirms a
+    state change. The current day, the effectors that are on and the last
+    time the manager was known alive are saved to a small snapshot file so
+    that they survive restarts. Finished days are appended to a history
+    file.
+    """
+
+    def __init__(self, effectors: list, file: str = None,
+                 history_file: str = None, writer=None):
+        self._effectors = {e.name: e for e in effectors}
+        self._file = file
+        self._history_file = history_file
+        self._writer = writer
+        # UTC day being counted, set by the first event
+        self.day = None
+        # Maps effector names to their counters for the current day
+        self.counters = dict()
+        # Maps the name of effectors currently on to the time they turned on
+        self._on_since = dict()
+        # Last time the manager was known to be running
+        self.alive = None
+
+        if file is not None and os.path.exists(file):
+            self.load()
+
+    def load(self):
+        """
+        Restore the counters saved before a restart. The MCU resets when the
+        serial port is opened, so effectors left on were only on until the
+        manager stopped: their intervals are closed at the last time it was
+        known alive.
+        """
+        try:
+            with open(self._file) as f:
+                snapshot = json.load(f)
+            day = date.fromisoformat(snapshot["day"])
+            counters = dict(snapshot["counters"])
+            on_since = {name: datetime.fromisoformat(since)
+                        for name, since in snapshot["on_since"].items()
+                        if name in self._effectors}
+            alive = datetime.fromisoformat(snapshot["alive"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.error(
+                f"failed to load effector usage from {self._file}, starting from zero: {e}")
+            return
+        self.day = day
+        self.counters = counters
+        self._on_since = on_since
+        self.alive = alive
+
+        self._roll_over(alive)
+        for name, since in self._on_since.items():
+            if since < alive:
+                self._add_on_time(self._counters(name), name, since, alive)
+        self._on_since = dict()
+        self.save()
+
+    def _counters(self, name: str) -> dict:
+        return self.counters.setdefault(
+            name, {"on_seconds": 0.0, "switch_count": 0, "energy_wh": 0.0})
+
+    def _add_on_time(self, counters: dict, name: str, start: datetime, end: datetime):
+        seconds = (end - start).total_seconds()
+        counters["on_seconds"] += seconds
+        counters["energy_wh"] += self._effectors[name].power_watts * seconds / 3600
+
+    def _roll_over(self, now: datetime):
+        """
+        Close every day before the one of 'now': add the on-time of the
+        effectors still on up to midnight and append the day to the history.
+        """
+        if self.day is None:
+            self.day = now.date()
+        while self.day < now.date():
+            midnight = datetime.combine(
+                self.day + timedelta(days=1), datetime.min.time(), timezone.utc)
+            for name in list(self._on_since):
+                self._add_on_time(self._counters(name), name,
+                                  self._on_since[name], midnight)
+                self._on_since[name] = midnight
+            if self._history_file is not None:
+                for name, counters in self.counters.items():
+                    save_row(self._history_file, USAGE_HISTORY_COLUMNS, [
+                        self.day.isoformat(), name,
+                        round(counters["on_seconds"], 1),
+                        counters["switch_count"],
+                        round(counters["energy_wh"], 3)], self._writer,
+                        keep=True)
+            self.counters = dict()
+            self.day += timedelta(days=1)
+
+    def switched_on(self, effector: Effector, now: datetime = None):
+        if now is None:
+            now = datetime.now(timezone.utc)
+        self._roll_over(now)
+        if effector.name not in self._on_since:
+            self._on_since[effector.name] = now
+            self._counters(effector.name)["switch_count"] += 1
+        self.save(now)
+
+    def switched_off(self, effector: Effector, now: datetime = None):
+        if now is None:
+            now = datetime.now(timezone.utc)
+        self._roll_over(now)
+        since = self._on_since.pop(effector.name, None)
+        if since is not None:
+            self._add_on_time(self._counters(effector.name),
+                              effector.name, since, now)
+        self.save(now)
+
+    def heartbeat(self, now: datetime = None):
+        """
+        Record that the manager is alive, at most once per
+        USAGE_HEARTBEAT_INTERVAL.
+        """
+        if now is None:
+            now = datetime.now(timezone.utc)
+        if self.alive is not None and now - self.alive < USAGE_HEARTBEAT_INTERVAL:
+            return
+        self._roll_over(now)
+        self.save(now)
+
+    def usage(self, now: datetime = None) -> dict:
+        """
+        Counters of the current day, including the time effectors have been
+        on so far.
+        """
+        if now is None:
+            now = datetime.now(timezone.utc)
+        self._roll_over(now)
+        usage = {name: dict(counters)
+                 for name, counters in self.counters.items()}
+        for name, since in self._on_since.items():
+            counters = usage.setdefault(
+                name, {"on_seconds": 0.0, "switch_count": 0, "energy_wh": 0.0})
+            self._add_on_time(counters, name, since, now)
+        return usage
+
+    def save(self, now: datetime = None):
+        if now is not None:
+            self.alive = now
+        if self._file is None or self.day is None or self.alive is None:
+            return
+        snapshot = {
+            "day": self.day.isoformat(),
+            "alive": self.alive.isoformat(),
+            "counters": self.counters,
+            "on_since": {name: since.isoformat()
+                         for name, since in self._on_since.items()},
+        }
+        save_snapshot(self._file, json.dumps(snapshot), self._writer)
+
+
 class EffectorManager():
     """
     The EffectorManager keeps track of all the effectors.
     """
 
     def __init__(self, file=None, water_pump=None, blower=None,
-                 radiator_valve=None, air_renew_valve=None):
+                 radiator_valve=None, air_renew_valve=None, writer=None,
+                 batch_msgs=BATCH_EFFECTOR_MSGS, usage_file=None,
+                 usage_history_file=None):
 
         self._file = file
+        self._writer = writer
 
         # Keep track of the unconfirmed state changes asked through serial
         self.expected_handshakes = dict()
 
+        # Whether state changes are sent in a single frame, and whether the
+        # MCU has ever acknowledged one.
+        self.batch_msgs = batch_msgs
+        self.batch_handshake_seen = False
+        self.frames_sent = 0
+        self.unacknowledged_frames = 0
+        self._last_unacknowledged_frame = 0
+
         self.water_pump: Effector = water_pump
         self.blower: Effector = blower
         self.radiator_valve: Effector = radiator_valve
@@ -127,23 +335,70 @@ class EffectorManager():
             self.radiator_valve,
             self.air_renew_valve]
 
-    def update_state(self, ser: serial.Serial, effector: Effector):
+        self.usage = EffectorUsage(
+            self.effectors, usage_file, usage_history_file, writer)
+
+    def pending_msg(self, effector: Effector):
         """
-        Update the state of a specific effector.
+        Get the message to send for the state change of an effector, or
+        None if the handshake for that very same message is still awaited.
         """
         msg: bytes = effector.get_msg()
         effector.update_prev_time_if_needed()
 
         if msg not in self.expected_handshakes:
-            # RPi is not waiting for serial to respond to this very same
-            # message
-            ser.write(msg)
             self.expected_handshakes[msg] = (Handshake(datetime.now(), msg))
+            return msg
         elif datetime.now() - self.expected_handshakes[msg].timestamp >= MAX_WAIT_HANDSHAKE:
             logging.error(
                 f"handshake from serial not received for message: {msg}")
             # Remove from expected handshake to retry forever
-            self.expected_handshakes.pop(msg)
+            handshake = self.expected_handshakes.pop(msg)
+            if handshake.frame is not None:
+                self.batch_frame_expired(handshake.frame)
+        return None
+
+    def batch_frame_expired(self, frame: int):
+        """
+        Count a batched frame that was not acknowledged in time. Batching is
+        turned off once too many in a row are lost and none was ever
+        acknowledged, as the MCU firmware then likely does not support it.
+        """
+        if frame <= self._last_unacknowledged_frame:
+            # Another message of this frame already expired
+            return
+        self._last_unacknowledged_frame = frame
+        self.unacknowledged_frames += 1
+        if self.batch_msgs and not self.batch_handshake_seen and \
+                self.unacknowledged_frames >= MAX_UNACKNOWLEDGED_FRAMES:
+            logging.warning(
+                "batched messages never acknowledged, falling back to single messages")
+            self.batch_msgs = False
+
+    def update_state(self, ser: serial.Serial, effector: Effector):
+        """
+        Update the state of a specific effector.
+        """
+        self.update_states(ser, [effector])
+
+    def update_states(self, ser: serial.Serial, effectors: list,
+                      batch: bool = True):
+        """
+        Update the state of several effectors. All messages are sent in a
+        single frame if batching is enabled, else one by one.
+        """
+        msgs = [msg for msg in map(self.pending_msg, effectors)
+                if msg is not None]
+        if not msgs:
+            return
+        if len(msgs) == 1 or not batch or not self.batch_msgs:
+            for msg in msgs:
+                ser.write(msg)
+            return
+        self.frames_sent += 1
+        for msg in msgs:
+            self.expected_handshakes[msg].frame = self.frames_sent
+        ser.write(BATCH_MSG_HEADER + b"".join(msgs) + BATCH_MSG_END)
 
     def manage(self, ser: serial.Serial, sensors):
         """
@@ -275,15 +530,17 @@ class EffectorManager():
             self.blower.toggle_on()
 
         # ----------- Emit all state update messages -------------
-        for e in self.effectors:
-            if e.state_change_occured():
-                self.update_state(ser, e)
+        self.update_states(
+            ser, [e for e in self.effectors if e.state_change_occured()])
+        self.usage.heartbeat()
 
     def turn_off_all(self, ser):
         logging.info("turning off all effectors to start")
         for e in self.effectors:
             e.toggle_off()
-            self.update_state(ser, e)
+        # The MCU may still be resetting after the port was opened, so do
+        # not let a lost frame count against batching.
+        self.update_states(ser, self.effectors, batch=False)
 
     def handshake_received(self, handshake_msg):
         """
@@ -317,9 +574,33 @@ class EffectorManager():
         elif handshake_msg == WATER_PUMP_OFF_MSG:
             self.water_pump.curr_state = State.OFF
 
+        # Update the usage counters
+        for e in self.effectors:
+            if handshake_msg == e.on_msg:
+                self.usage.switched_on(e)
+            elif handshake_msg == e.off_msg:
+                self.usage.switched_off(e)
+
         logging.info(
             f"handshake received for the following message: {handshake_msg}")
 
+    def batch_handshake_received(self, handshake_msgs: bytes):
+        """
+        Update the effector states for every message acknowledged in a
+        batched handshake.
+        """
+        self.batch_handshake_seen = True
+        self.unacknowledged_frames = 0
+        for i in range(len(handshake_msgs)):
+            msg = handshake_msgs[i:i + 1]
+            if msg in self.expected_handshakes:
+                self.handshake_received(msg)
+            elif msg in ALL_MSG:
+                logging.warning(
+                    f"expired handshake {msg} received but not accepted")
+            else:
+                logging.error(f"unknown message {msg} in batched handshake")
+
     def save_logs_to_file(self):
         column_names = ["timestamp_utc", "air_blower", "water_pump",
                         "radiator_valve", "air_renew_valve"]
@@ -330,17 +611,142 @@ class EffectorManager():
             self.radiator_valve.curr_state,
             self.air_renew_valve.curr_state
         ]
-        create_file_if_not_exist(self._file, column_names)
-        write_data_to_file(self._file, row_values)
+        save_row(self._file, column_names, row_values, self._writer)
+
+
+class SensorHistory():
+    """
+    SensorHistory keeps the most recent sensor readings in fixed-size arrays
+    used as ring buffers. Memory stays constant and trends can be queried
+    without reading the logs back from disk. Readings are timed with the
+    monotonic clock, as the Pi has no RTC and NTP may step the wall clock.
+    """
+
+    def __init__(self, capacity: int = SENSOR_HISTORY_CAPACITY):
+        self.capacity = capacity
+        self.size = 0
+        self._next = 0
+        self._timestamps = array('d', bytes(8 * capacity))
+        self._values = {
+            field: array('d', bytes(8 * capacity))
+            for field in SENSOR_FIELDS if field != "timestamp_utc"}
+
+    def append(self, timestamp: float, values: dict):
+        """
+        Add a reading, overwriting the oldest one once the buffer is full.
+        Timestamps are time.monotonic() seconds and must not decrease.
+        """
+        if self.size and timestamp < self._timestamps[self._position(self.size - 1)]:
+            raise ValueError(
+                f"sensor history timestamp {timestamp} is older than the last reading")
+        i = self._next
+        self._timestamps[i] = timestamp
+        for field, column in self._values.items():
+            column[i] = values[field]
+        self._next = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def _position(self, k: int) -> int:
+        """
+        Array position of the k-th oldest reading.
+        """
+        return (self._next - self.size + k) % self.capacity
+
+    def _window_start(self, since: float) -> int:
+        """
+        Index of the oldest reading taken at or after 'since'.
+        """
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamps[self._position(mid)] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _slice(self, column: array, start: int) -> array:
+        first = self._position(start)
+        end = first + self.size - start
+        if end <= self.capacity:
+            return column[first:end]
+        return column[first:] + column[:end - self.capacity]
+
+    def window(self, field: str, duration: timedelta, now: float = None) -> array:
+        """
+        Values of a sensor field over the last 'duration', oldest first.
+        """
+        if now is None:
+            now = time.monotonic()
+        start = self._window_start(now - duration.total_seconds())
+        return self._slice(self._values[field], start)
+
+    def mean(self, field: str, duration: timedelta, now: float = None):
+        values = self.window(field, duration, now)
+        if not values:
+            return None
+        return sum(values) / len(values)
+
+    def min(self, field: str, duration: timedelta, now: float = None):
+        values = self.window(field, duration, now)
+        return min(values) if values else None
+
+    def max(self, field: str, duration: timedelta, now: float = None):
+        values = self.window(field, duration, now)
+        return max(values) if values else None
+
+    def slope(self, field: str, duration: timedelta, now: float = None):
+        """
+        Least-squares trend of a sensor field in units per minute.
+        """
+        if now is None:
+            now = time.monotonic()
+        start = self._window_start(now - duration.total_seconds())
+        times = self._slice(self._timestamps, start)
+        values = self._slice(self._values[field], start)
+        n = len(values)
+        if n < 2:
+            return None
+        mean_t = sum(times) / n
+        mean_v = sum(values) / n
+        var_t = sum((t - mean_t) ** 2 for t in times)
+        if var_t == 0:
+            return None
+        cov = sum((t - mean_t) * (v - mean_v) for t, v in zip(times, values))
+        return cov / var_t * 60
+
+    def stayed_below(self, field: str, threshold: float,
+                     duration: timedelta, now: float = None) -> bool:
+        """
+        True if every reading over the last 'duration' was below 'threshold'
+        and readings cover the whole window, with no gap longer than
+        SENSOR_HISTORY_MAX_GAP.
+        """
+        if now is None:
+            now = time.monotonic()
+        since = now - duration.total_seconds()
+        start = self._window_start(since)
+        times = self._slice(self._timestamps, start)
+        if not times:
+            return False
+        max_gap = SENSOR_HISTORY_MAX_GAP.total_seconds()
+        if times[0] - since > max_gap or now - times[-1] > max_gap:
+            return False
+        if any(b - a > max_gap for a, b in zip(times, times[1:])):
+            return False
+        return max(self._slice(self._values[field], start)) < threshold
 
 
 class SensorValues():
     """
-    SensorValues stores the current sensor values.
+    SensorValues stores the current sensor values and a history of
+    recent readings.
     """
 
-    def __init__(self, file: str):
+    def __init__(self, file: str, writer=None):
         self._file = file
+        self._writer = writer
+        self.history = SensorHistory()
         self.air_O2 = None  # Not implemented, sensor missing
         self.air_hum = None
         self.air_temp = None
@@ -350,9 +756,8 @@ class SensorValues():
 
     def update_values(self, raw_line: str):
         split_data = raw_line.split()
-        self.current_time = datetime.now(
-            timezone.utc).replace(
-            microsecond=0).isoformat()
+        now = datetime.now(timezone.utc)
+        self.current_time = now.replace(microsecond=0).isoformat()
         self.air_hum = float(
             split_data[SENSOR_FIELDS["system_air_humidity"]][:-1])
         self.air_temp = float(
@@ -361,6 +766,12 @@ class SensorValues():
         self.soil_hum = float(split_data[SENSOR_FIELDS["soil_humidity"]][:-1])
         self.soil_temp = float(
             split_data[SENSOR_FIELDS["soil_temperature"]][:-2])
+        self.history.append(time.monotonic(), {
+            "soil_humidity": self.soil_hum,
+            "soil_temperature": self.soil_temp,
+            "system_air_humidity": self.air_hum,
+            "system_air_temperature": self.air_temp,
+        })
 
     def to_list(self):
         l = list()
@@ -375,13 +786,138 @@ class SensorValues():
         return SENSOR_FIELDS.keys()
 
     def save_logs_to_file(self):
-        create_file_if_not_exist(self._file, self.column_names())
-        write_data_to_file(self._file, self.to_list())
+        save_row(self._file, self.column_names(), self.to_list(), self._writer)
 
     def log_to_console(self):
         log = f"air_hum: {self.air_hum}%, air_temp: {self.air_temp}ºC, soil_hum: {self.soil_hum}%, soil_temp: {self.soil_temp}ºC"
         logging.info(log)
 
+
+class LogWriter():
+    """
+    LogWriter hands log rows to a separate process that writes them to disk
+    and periodically uploads them, so the serial loop never waits on the SD
+    card or on git. The queue is bounded: when it is full, rows are dropped
+    and counted instead of blocking the caller. Records that must not be
+    lost are held back and queued again once there is room.
+    """
+
+    def __init__(self, repo_path: str = None, files: list = None,
+                 maxsize: int = LOG_QUEUE_MAXSIZE):
+        self._repo_path = repo_path
+        self._files = files
+        self._queue = LOG_WRITER_CONTEXT.Queue(maxsize)
+        self._process = None
+        # Records to keep that did not fit in the queue, oldest first
+        self._backlog = collections.deque()
+        self._last_report = datetime.now()
+        self.maxsize = maxsize
+        self.dropped = 0
+
+    def start(self):
+        """
+        Start the writer process, or start a new one if the previous one died.
+        """
+        self._process = LOG_WRITER_CONTEXT.Process(
+            target=run_log_writer,
+            args=(self._queue, self._repo_path, self._files),
+            daemon=True)
+        self._process.start()
+
+    def stop(self, timeout: timedelta = LOG_WRITER_STOP_TIMEOUT):
+        """
+        Ask the writer process to write pending records and exit. Kill it if
+        it has not finished within 'timeout'.
+        """
+        if self._process is None:
+            return
+        try:
+            while self._backlog:
+                self._queue.put(self._backlog[0],
+                                timeout=timeout.total_seconds())
+                self._backlog.popleft()
+            self._queue.put(None, timeout=timeout.total_seconds())
+        except queue.Full:
+            logging.error(
+                f"log queue still full at shutdown, {len(self._backlog)} held records lost")
+        self._process.join(timeout.total_seconds())
+        if self._process.is_alive():
+            logging.error("log writer did not finish in time, killing it")
+            self._queue.cancel_join_thread()
+            self._process.kill()
+
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def supervise(self):
+        """
+        Start a new writer process if the current one died. Must be called
+        from the main thread, never from the serial loop.
+        """
+        if self._process is None or self._process.is_alive():
+            return
+        logging.error(
+            f"log writer process exited with code {self._process.exitcode}, restarting it")
+        self.start()
+
+    def _flush_backlog(self):
+        while self._backlog:
+            try:
+                self._queue.put_nowait(self._backlog[0])
+            except queue.Full:
+                return
+            self._backlog.popleft()
+
+    def _put(self, record: tuple, keep: bool = False) -> bool:
+        self._flush_backlog()
+        if not self._backlog:
+            try:
+                self._queue.put_nowait(record)
+                return True
+            except queue.Full:
+                pass
+        if keep:
+            self._backlog.append(record)
+            logging.warning(
+                f"log queue full, holding record for {record[1]} until there is room")
+            return True
+        self.dropped += 1
+        logging.warning(
+            f"log queue full, dropped record for {record[1]} ({self.dropped} dropped so far)")
+        return False
+
+    def submit(self, filename: str, column_names, row, keep: bool = False) -> bool:
+        """
+        Queue a row without blocking. Return false if it was dropped, which
+        never happens for rows to keep.
+        """
+        return self._put((RECORD_ROW, filename, list(column_names), list(row)),
+                         keep)
+
+    def submit_snapshot(self, filename: str, content: str) -> bool:
+        """
+        Queue the full content of a file without blocking. Only the latest
+        queued content of a file is written. Snapshots are never dropped.
+        """
+        return self._put((RECORD_SNAPSHOT, filename, None, content), keep=True)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def log_to_console(self):
+        """
+        Report the queue depth and dropped rows on a set interval.
+        """
+        self._flush_backlog()
+        if datetime.now() - self._last_report < LOG_QUEUE_REPORT_INTERVAL:
+            return
+        self._last_report = datetime.now()
+        if self._process is not None and not self._process.is_alive():
+            logging.error("log writer process is not running")
+        logging.info(
+            f"log queue depth: {self.queue_depth()}/{self.maxsize}, "
+            f"held: {len(self._backlog)}, dropped: {self.dropped}")
+
 ################################################################
 
 
@@ -391,13 +927,14 @@ def manage_serial(
     effectors: EffectorManager,
     sensor_logs_filepath: str,
     test_all_systems: bool = False,
+    writer: LogWriter = None,
 ):
     """
-    Reads serial data and writes it to disk.
+    Reads serial data and hands it to the log writer.
     """
     ser = serial.Serial(serial_port, baud_rate, timeout=1)
     ser.flush()
-    sensor_vals = SensorValues(sensor_logs_filepath)
+    sensor_vals = SensorValues(sensor_logs_filepath, writer=writer)
     effectors.turn_off_all(ser)
     if test_all_systems:
         ser.write(RUN_ALL_EFFECTORS)
@@ -409,10 +946,12 @@ def manage_serial(
             line = ser.readline().decode('utf-8').rstrip()
             logging.debug(line)
             handle_msg(line, sensor_vals, effectors, ser)
+            if writer is not None:
+                writer.log_to_console()
 
 
 def handle_msg(msg: str, sensors: SensorValues,
-               effectors: EffectorManager, : serial.Serial):
+               effectors: EffectorManager, ser: serial.Serial):
     """
     Parses serial messages, updates effectors, and writes to disk if needed.
     Return true if new information is acquired.
@@ -430,6 +969,8 @@ def handle_msg(msg: str, sensors: SensorValues,
             effectors.save_logs_to_file()
     elif msg[0] == HEADER_LOG_DATA:
         logging.info(f"SERIAL IN: {msg[1:].strip()}")
+    elif msg[0] == HEADER_BATCH_HANDSHAKE:
+        effectors.batch_handshake_received(msg[1:].strip().encode())
     elif msg[0].encode() in effectors.expected_handshakes.keys():
         effectors.handshake_received(msg[0].encode())
     elif msg[0].encode() in ALL_MSG:
@@ -454,16 +995,120 @@ def write_data_to_file(filename: str, line: str):
         writer.writerow(line)
 
 
-def upload_changes_to_cloud(repo, files: dict):
+def write_rows_to_file(filename: str, lines: list):
+    with open(filename, "a") as f:
+        writer = csv.writer(f)
+        writer.writerows(lines)
+
+
+def save_row(filename: str, column_names, row, writer: LogWriter = None,
+             keep: bool = False):
+    """
+    Write a row through the log writer if there is one, else write it now.
+    """
+    if writer is not None:
+        writer.submit(filename, column_names, row, keep)
+        return
+    create_file_if_not_exist(filename, column_names)
+    write_data_to_file(filename, row)
+
+
+def write_snapshot_to_file(filename: str, content: str):
+    """
+    Replace the content of a file without ever leaving it half written.
+    """
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        f.write(content)
+    os.replace(tmp_filename, filename)
+
+
+def save_snapshot(filename: str, content: str, writer: LogWriter = None):
+    """
+    Write a snapshot through the log writer if there is one, else write it now.
+    """
+    if writer is not None:
+        writer.submit_snapshot(filename, content)
+        return
+    write_snapshot_to_file(filename, content)
+
+
+def run_log_writer(log_queue, repo_path: str = None, files: list = None):
+    """
+    Entry point of the writer process. Ctrl-C and SIGTERM are left to the
+    manager, which stops the writer once pending records are queued.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    persist_logs(log_queue, repo_path, files)
+
+
+def persist_logs(log_queue, repo_path: str = None, files: list = None):
+    """
+    Writer process loop. Drains queued records, appends rows grouped per
+    file, writes the latest snapshot of each file, and uploads the data
+    files to the cloud on a set interval. Exits once the None sentinel is
+    received or the manager is gone.
+    """
+    repo = git.Repo(repo_path) if repo_path else None
+    parent_pid = os.getppid()
     start_time = datetime.now()
-    while True:
-        if datetime.now() - start_time >= UPLOAD_INTERVAL_SECONDS:
+    running = True
+    while running:
+        records = []
+        try:
+            records.append(log_queue.get(
+                timeout=LOG_QUEUE_POLL_INTERVAL.total_seconds()))
+            while len(records) < LOG_QUEUE_MAXSIZE:
+                records.append(log_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        if None in records:
+            running = False
+            records = records[:records.index(None)]
+        elif os.getppid() != parent_pid:
+            logging.error("manager exited, stopping log writer")
+            running = False
+
+        column_names_per_file = dict()
+        rows_per_file = dict()
+        snapshots = dict()
+        for kind, filename, column_names, payload in records:
+            if kind == RECORD_SNAPSHOT:
+                snapshots[filename] = payload
+                continue
+            column_names_per_file[filename] = column_names
+            rows_per_file.setdefault(filename, []).append(payload)
+        # A failing file loses its batch but must not kill the writer
+        for filename, rows in rows_per_file.items():
+            try:
+                create_file_if_not_exist(
+                    filename, column_names_per_file[filename])
+                write_rows_to_file(filename, rows)
+            except OSError as e:
+                logging.error(
+                    f"failed to write {len(rows)} rows to {filename}: {e}")
+        for filename, content in snapshots.items():
+            try:
+                write_snapshot_to_file(filename, content)
+            except OSError as e:
+                logging.error(f"failed to write {filename}: {e}")
+
+        if repo is not None and datetime.now() - start_time >= UPLOAD_INTERVAL_SECONDS:
             start_time = datetime.now()
-            repo.index.add(files)
-            repo.index.commit("Push data")
-            logging.info("start pushing data updates to repo...")
-            repo.remotes.origin.push()
-            logging.info("finished pushing data updates to repo.")
+            try:
+                upload_changes_to_cloud(repo, files)
+            except (git.GitError, OSError) as e:
+                logging.error(f"failed to upload data updates to repo: {e}")
+
+
+def upload_changes_to_cloud(repo, files: list):
+    repo.index.add([f for f in files if os.path.exists(f)])
+    repo.index.commit("Push data")
+    logging.info("start pushing data updates to repo...")
+    repo.remotes.origin.push()
+    logging.info("finished pushing data updates to repo.")
 
 
 def current_time_is_at_night() -> bool:
@@ -477,50 +1122,68 @@ def current_time_is_at_night() -> bool:
 if __name__ == '__main__':
     # Thead example from
     # https://stackoverflow.com/questions/23100704/running-infinite-loops-using-threads-in-python
-    repo = git.Repo(os.path.dirname(os.path.realpath(__file__)))
+    files = [SENSOR_DATA_FILEPATH, EFFECTOR_DATA_FILEPATH,
+             EFFECTOR_USAGE_FILEPATH, EFFECTOR_USAGE_HISTORY_FILEPATH]
+
+    # Disk writes and git uploads happen in their own process so that they
+    # never hold the GIL or block the serial loop.
+    writer = LogWriter(
+        repo_path=os.path.dirname(os.path.realpath(__file__)),
+        files=files)
+    writer.start()
 
     water_pump = Effector(
         name="water pump",
         on_interval=WATER_PUMP_ON_INTERVAL,
         off_interval=WATER_PUMP_OFF_INTERVAL,
         on_msg=WATER_PUMP_ON_MSG,
-        off_msg=WATER_PUMP_OFF_MSG)
+        off_msg=WATER_PUMP_OFF_MSG,
+        power_watts=WATER_PUMP_POWER_W)
 
     blower = Effector(
         name="blower",
         on_interval=BLOWER_ON_INTERVAL,
         off_interval=BLOWER_OFF_INTERVAL,
         on_msg=BLOWER_ON_MSG,
-        off_msg=BLOWER_OFF_MSG)
+        off_msg=BLOWER_OFF_MSG,
+        power_watts=BLOWER_POWER_W)
 
     radiator_valve = Effector(
         name="radiator valve",
         on_interval=RADIATOR_VALVE_ON_INTERVAL,
         on_msg=RADIATOR_ON_MSG,
-        off_msg=RADIATOR_OFF_MSG)
+        off_msg=RADIATOR_OFF_MSG,
+        power_watts=RADIATOR_VALVE_POWER_W)
 
     air_renew_valve = Effector(
         name="air renewal valve",
         on_interval=AIR_RENEW_ON_INTERVAL,
         off_interval=AIR_RENEW_OFF_INTERVAL,
         on_msg=AIR_RENEW_ON_MSG,
-        off_msg=AIR_RENEW_OFF_MSG)
+        off_msg=AIR_RENEW_OFF_MSG,
+        power_watts=AIR_RENEW_VALVE_POWER_W)
 
     effectors = EffectorManager(
         file=EFFECTOR_DATA_FILEPATH,
         water_pump=water_pump,
         blower=blower,
         radiator_valve=radiator_valve,
-        air_renew_valve=air_renew_valve)
-
-    files = [SENSOR_DATA_FILEPATH, EFFECTOR_DATA_FILEPATH]
-
-    t1 = Thread(target=manage_serial, args=(SERIAL_NAME, BAUD_RATE,
-                                            effectors, SENSOR_DATA_FILEPATH, test_all_systems=TEST_ALL_SYSTEMS, ))
-    t2 = Thread(target=upload_changes_to_cloud, args=(repo, files, ))
-    t1.setDaemon(True)
-    t2.setDaemon(True)
-    t1.start()
-    t2.start()
-    while True:
-        pass
+        air_renew_valve=air_renew_valve,
+        writer=writer,
+        usage_file=EFFECTOR_USAGE_FILEPATH,
+        usage_history_file=EFFECTOR_USAGE_HISTORY_FILEPATH)
+
+    t1 = Thread(target=manage_serial,
+                args=(SERIAL_NAME, BAUD_RATE, effectors, SENSOR_DATA_FILEPATH, ),
+                kwargs={"test_all_systems": TEST_ALL_SYSTEMS, "writer": writer})
+    t1.daemon = True
+
+    # Let systemd stop the manager like Ctrl-C so queued logs get written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        t1.start()
+        while t1.is_alive():
+            t1.join(LOG_WRITER_SUPERVISE_INTERVAL.total_seconds())
+            writer.supervise()
+    finally:
+        writer.stop()
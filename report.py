@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Daily report over the sensor and effector logs.
+
+The logs are read in fixed-size blocks and each block is parsed and reduced
+with NumPy, so memory stays constant no matter how long the logs are. A row's
+values are assumed to hold until the next row; gaps longer than
+MAX_SAMPLE_GAP (e.g. while the manager was stopped) are not counted.
+
+Usage:
+    python3 report.py [--sensors PATH] [--effectors PATH] [--jobs N]
+"""
+import argparse
+import logging
+import os
+from datetime import timedelta
+from multiprocessing import Pool
+
+import numpy as np
+
+from constants import *
+
+# Bytes of log read and reduced at once
+CHUNK_BYTES = 4 * 1024 * 1024
+
+# Readings further apart than this are treated as a gap in the logs
+MAX_SAMPLE_GAP = timedelta(minutes=1)
+
+EFFECTOR_COLUMNS = ["air_blower", "water_pump",
+                    "radiator_valve", "air_renew_valve"]
+
+# Effector states were logged either as booleans or as State members
+ON_VALUES = [b"True", b"State.ON"]
+OFF_VALUES = [b"False", b"State.OFF"]
+
+# Time a channel must stay off before it turning on again counts as a new
+# rise. While drying, the manager keeps the blower, radiator and air renewal
+# valve off for DRYING_OFF_INTERVAL between cycles. Their own schedules make
+# them overlap and flicker much more often than that.
+DEBOUNCE = {"drying": DRYING_OFF_INTERVAL}
+
+
+def to_float(column: np.ndarray) -> np.ndarray:
+    """
+    Convert a byte-string column to floats, with NaN for corrupt values.
+    """
+    try:
+        return column.astype(float)
+    except ValueError:
+        return np.array([_float_or_nan(value) for value in column])
+
+
+def _float_or_nan(value: bytes) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def to_times(column: np.ndarray) -> np.ndarray:
+    """
+    Convert a byte-string column of ISO timestamps to datetime64[s], with
+    NaT for corrupt values.
+    """
+    column = column.astype("S19")
+    try:
+        return column.astype("datetime64[s]")
+    except ValueError:
+        return np.array([_time_or_nat(value) for value in column],
+                        dtype="datetime64[s]")
+
+
+def _time_or_nat(value: bytes):
+    try:
+        return np.datetime64(value.decode(), "s")
+    except ValueError:
+        return np.datetime64("NaT")
+
+
+def effector_channels(columns: dict):
+    """
+    Boolean channels derived from an effector log block, along with a mask
+    of the rows whose values are all valid. A drying cycle is the blower,
+    radiator and air renewal valve all on, which is how the manager dries
+    the compost.
+    """
+    valid = np.ones(len(columns[EFFECTOR_COLUMNS[0]]), dtype=bool)
+    channels = dict()
+    for name in EFFECTOR_COLUMNS:
+        channels[name] = np.isin(columns[name], ON_VALUES)
+        valid &= channels[name] | np.isin(columns[name], OFF_VALUES)
+    channels["drying"] = channels["air_blower"] & \
+        channels["radiator_valve"] & channels["air_renew_valve"]
+    return channels, valid
+
+
+def sensor_channels(columns: dict):
+    """
+    Boolean channels derived from a sensor log block, one per threshold
+    used by the manager, along with a mask of the rows whose values are
+    all valid.
+    """
+    soil_hum = to_float(columns["soil_humidity"])
+    soil_temp = to_float(columns["soil_temperature"])
+    air_hum = to_float(columns["system_air_humidity"])
+    valid = ~(np.isnan(soil_hum) | np.isnan(soil_temp) | np.isnan(air_hum))
+    return {
+        "soil_humidity < SOIL_H2O_MIN": soil_hum < SOIL_H2O_MIN,
+        "soil_humidity >= SOIL_H2O_MAX": soil_hum >= SOIL_H2O_MAX,
+        "soil_temperature >= SOIL_TEMP_MAX": soil_temp >= SOIL_TEMP_MAX,
+        "system_air_humidity > AIR_H2O_MAX": air_hum > AIR_H2O_MAX,
+    }, valid
+
+
+CHANNELS = {
+    "effectors": effector_channels,
+    "sensors": sensor_channels,
+}
+
+
+class DailyTotals():
+    """
+    Per-day totals of a log. For each day, stores the observed seconds and,
+    for every channel, the seconds it was true and the number of times it
+    switched from false to true.
+    """
+
+    def __init__(self, names: list):
+        self.names = names
+        self.days = dict()
+        self.debounce = np.array([DEBOUNCE.get(name, timedelta(0)).total_seconds()
+                                  for name in names])
+
+    def add(self, days: np.ndarray, observed: np.ndarray,
+            on_seconds: np.ndarray, rises: np.ndarray):
+        for i, day in enumerate(days):
+            totals = self.days.setdefault(
+                day, np.zeros(1 + 2 * len(self.names)))
+            totals[0] += observed[i]
+            totals[1:1 + len(self.names)] += on_seconds[i]
+            totals[1 + len(self.names):] += rises[i]
+
+    def remove_rise(self, day, k: int):
+        self.days[day][1 + len(self.names) + k] -= 1
+
+    def merge(self, other):
+        for day, totals in other.days.items():
+            if day in self.days:
+                self.days[day] += totals
+            else:
+                self.days[day] = totals.copy()
+
+    def observed(self, day) -> float:
+        return self.days[day][0]
+
+    def on_seconds(self, day, name: str) -> float:
+        return self.days[day][1 + self.names.index(name)]
+
+    def rises(self, day, name: str) -> int:
+        return int(self.days[day][1 + len(self.names) + self.names.index(name)])
+
+
+def summarize(totals: DailyTotals, times: np.ndarray, states: np.ndarray,
+              last_on: np.ndarray) -> np.ndarray:
+    """
+    Add the intervals between consecutive rows to the totals. 'times' is a
+    datetime64[s] array and 'states' a boolean array with one column per
+    channel. 'last_on' holds, per channel, the last time in seconds it was
+    on before these rows, used to debounce rises. Intervals are counted on
+    the day they start and rises on the day they happen. Return the
+    updated 'last_on'.
+    """
+    seconds = times.astype("int64").astype(float)
+    on_times = np.where(states, seconds[:, None], -np.inf)
+    # Last time each channel was on before each row
+    last_on_before = np.maximum.accumulate(
+        np.vstack([last_on, on_times]), axis=0)
+    if len(times) < 2:
+        return last_on_before[-1]
+
+    dt = np.diff(seconds)
+    dt[(dt < 0) | (dt > MAX_SAMPLE_GAP.total_seconds())] = 0
+    rises = states[1:] & ~states[:-1] & \
+        (seconds[1:, None] - last_on_before[1:-1] >= totals.debounce)
+
+    days, index = np.unique(times.astype("datetime64[D]"), return_inverse=True)
+    index = index.reshape(-1)
+    starts, ends = index[:-1], index[1:]
+    observed = np.bincount(starts, weights=dt, minlength=len(days))
+    on_seconds = np.stack([
+        np.bincount(starts, weights=dt * states[:-1, k], minlength=len(days))
+        for k in range(states.shape[1])], axis=1)
+    rise_counts = np.stack([
+        np.bincount(ends, weights=rises[:, k], minlength=len(days))
+        for k in range(states.shape[1])], axis=1)
+    totals.add(days, observed, on_seconds, rise_counts)
+    return last_on_before[-1]
+
+
+def read_blocks(path: str, start: int, end: int):
+    """
+    Yield blocks of the whole lines that start within [start, end).
+    """
+    with open(path, "rb") as f:
+        f.seek(start - 1)
+        if f.read(1) != b"\n":
+            f.readline()
+        while f.tell() < end:
+            block = f.read(min(CHUNK_BYTES, end - f.tell()))
+            if not block.endswith(b"\n"):
+                block += f.readline()
+            yield block
+
+
+def parse_block(block: bytes, header: list):
+    """
+    Split a block of CSV lines into a datetime64 array and a dict of
+    byte-string columns. Lines with missing or extra fields, such as a line
+    cut short by a power loss, are skipped. Also return how many were.
+    """
+    data = block.replace(b"\r", b"").strip(b"\n")
+    if not data:
+        return None, None, 0
+    separators = len(header) - 1
+
+    # Count the separators of every line at once to spot malformed lines
+    chars = np.frombuffer(data, dtype=np.uint8)
+    line_ends = np.append(np.flatnonzero(chars == ord("\n")), len(chars) - 1)
+    comma_positions = np.flatnonzero(chars == ord(","))
+    commas = np.diff(np.searchsorted(comma_positions, line_ends), prepend=0)
+    if np.all(commas == separators) and b",," not in data and \
+            b"\n," not in data and b",\n" not in data and \
+            not data.startswith(b",") and not data.endswith(b","):
+        fields = data.replace(b"\n", b",").split(b",")
+        skipped = 0
+    else:
+        lines = [line for line in data.split(b"\n") if line]
+        rows = [line for line in lines
+                if line.count(b",") == separators and b",," not in line
+                and not line.startswith(b",") and not line.endswith(b",")]
+        skipped = len(lines) - len(rows)
+        if not rows:
+            return None, None, skipped
+        fields = b",".join(rows).split(b",")
+    table = np.array(fields).reshape(-1, len(header))
+    times = to_times(table[:, 0])
+    columns = {name: table[:, i] for i, name in enumerate(header)}
+    return times, columns, skipped
+
+
+def summarize_range(path: str, kind: str, start: int, end: int):
+    """
+    Reduce the rows starting within [start, end) of a log. Rows with corrupt
+    values are skipped. Return the totals, the first and last rows, and per
+    channel the time of its first and last on rows, so that neighbouring
+    ranges can be stitched together, along with the number of lines skipped.
+    """
+    with open(path) as f:
+        header = f.readline().strip().split(",")
+    totals = None
+    first = last = None
+    first_on = last_on = None
+    skipped = 0
+    for block in read_blocks(path, start, end):
+        times, columns, block_skipped = parse_block(block, header)
+        skipped += block_skipped
+        if times is None:
+            continue
+        channels, valid = CHANNELS[kind](columns)
+        valid &= ~np.isnat(times)
+        skipped += np.count_nonzero(~valid)
+        if not valid.any():
+            continue
+        times = times[valid]
+        states = np.stack(list(channels.values()), axis=1)[valid]
+        if totals is None:
+            totals = DailyTotals(list(channels))
+            first = (times[:1], states[:1])
+            first_on = np.full(len(channels), np.inf)
+            last_on = np.full(len(channels), -np.inf)
+
+        seconds = times.astype("int64").astype(float)
+        first_on = np.minimum(first_on, np.where(
+            states.any(axis=0), seconds[states.argmax(axis=0)], np.inf))
+        if last is not None:
+            times = np.concatenate([last[0], times])
+            states = np.concatenate([last[1], states])
+        last_on = summarize(totals, times, states, last_on)
+        last = (times[-1:], states[-1:])
+    return totals, first, last, first_on, last_on, skipped
+
+
+def summarize_log(path: str, kind: str, jobs: int = 1) -> DailyTotals:
+    """
+    Reduce a whole log, optionally splitting it in byte ranges processed on
+    'jobs' cores. Return None if the log has no rows.
+    """
+    with open(path, "rb") as f:
+        f.readline()
+        data_start = f.tell()
+    size = os.path.getsize(path)
+    if size <= data_start:
+        return None
+    bounds = np.linspace(data_start, size, jobs + 1).astype(int)
+    ranges = [(path, kind, int(bounds[i]), int(bounds[i + 1]))
+              for i in range(jobs)]
+    if jobs > 1:
+        with Pool(jobs) as pool:
+            results = pool.starmap(summarize_range, ranges)
+    else:
+        results = [summarize_range(*r) for r in ranges]
+
+    skipped = sum(result[-1] for result in results)
+    if skipped:
+        logging.warning(f"skipped {skipped} malformed lines in {path}")
+
+    totals = None
+    last = last_on = None
+    for part, first, part_last, part_first_on, part_last_on, _ in results:
+        if part is None:
+            continue
+        if totals is None:
+            totals = part
+            last_on = part_last_on
+        else:
+            totals.merge(part)
+            # The first rise within a range could not be debounced against
+            # the ranges before it
+            for k in np.flatnonzero(~first[1][0] &
+                                    (part_first_on - last_on < totals.debounce)):
+                day = np.datetime64(int(part_first_on[k]), "s").astype(
+                    "datetime64[D]")
+                totals.remove_rise(day, k)
+            # The interval between two ranges belongs to neither
+            last_on = summarize(totals, np.concatenate([last[0], first[0]]),
+                                np.concatenate([last[1], first[1]]), last_on)
+            last_on = np.maximum(last_on, part_last_on)
+        last = part_last
+    return totals
+
+
+def print_report(sensors: DailyTotals, effectors: DailyTotals):
+    days = sorted(set(sensors.days if sensors else []) |
+                  set(effectors.days if effectors else []))
+    for day in days:
+        print(f"=== {day} ===")
+        if effectors is not None and day in effectors.days:
+            observed = effectors.observed(day)
+            print(f"effector log coverage: {observed / 3600:.2f} h")
+            for name in EFFECTOR_COLUMNS:
+                on = effectors.on_seconds(day, name)
+                duty = 100 * on / observed if observed else 0
+                print(f"  {name:<20} duty {duty:6.2f}%  "
+                      f"on {on / 3600:6.2f} h  "
+                      f"switched on {effectors.rises(day, name)} times")
+            print(f"  watering events: {effectors.rises(day, 'water_pump')}")
+            print(f"  drying cycles: {effectors.rises(day, 'drying')}")
+        if sensors is not None and day in sensors.days:
+            print(
+                f"sensor log coverage: {sensors.observed(day) / 3600:.2f} h")
+            for name in sensors.names:
+                print(f"  {name:<36} "
+                      f"{sensors.on_seconds(day, name) / 3600:6.2f} h")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Daily report over the sensor and effector logs.")
+    parser.add_argument("--sensors", default=SENSOR_DATA_FILEPATH)
+    parser.add_argument("--effectors", default=EFFECTOR_DATA_FILEPATH)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of cores to process each log on")
+    args = parser.parse_args()
+
+    sensors = effectors = None
+    if os.path.exists(args.sensors):
+        sensors = summarize_log(args.sensors, "sensors", args.jobs)
+    else:
+        logging.warning(f"sensor log {args.sensors} not found")
+    if os.path.exists(args.effectors):
+        effectors = summarize_log(args.effectors, "effectors", args.jobs)
+    else:
+        logging.warning(f"effector log {args.effectors} not found")
+    print_report(sensors, effectors)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,10 @@
+import copy
 import pytest
 import logging
 import serial
 import manager
 from constants import *
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from unittest.mock import MagicMock
 from manager import Effector, EffectorManager, SensorValues
 
@@ -161,3 +162,365 @@ def test_state(case):
         assert(handshake in case.effectors.expected_handshakes.keys())
     assert(len(case.expected_handshakes) == len(
         case.effectors.expected_handshakes))
+
+
+def test_log_writer_drops_rows_when_queue_full():
+    writer = manager.LogWriter(maxsize=1)
+    assert(writer.submit("file", ["a"], [1]))
+    assert(not writer.submit("file", ["a"], [2]))
+    assert(writer.dropped == 1)
+    # Rows to keep are held until there is room
+    assert(writer.submit("file", ["a"], [3], keep=True))
+    assert(writer.dropped == 1)
+
+
+def test_persist_logs_writes_queued_rows(tmp_path):
+    filename = str(tmp_path / "values.csv")
+    log_queue = manager.LOG_WRITER_CONTEXT.Queue()
+    for i in range(3):
+        log_queue.put((manager.RECORD_ROW, filename,
+                       ["timestamp_utc", "value"], [i, i * 10]))
+    log_queue.put(None)
+
+    manager.persist_logs(log_queue)
+
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    assert(lines == ["timestamp_utc,value", "0,0", "1,10", "2,20"])
+
+
+def make_history(capacity, readings):
+    history = manager.SensorHistory(capacity)
+    for t, soil_hum in readings:
+        history.append(t, {
+            "soil_humidity": soil_hum,
+            "soil_temperature": 40,
+            "system_air_humidity": 60,
+            "system_air_temperature": 20,
+        })
+    return history
+
+
+def test_sensor_history_wraps_around():
+    # 10 readings, one per minute, in a buffer that only keeps 4
+    history = make_history(4, [(60 * i, float(i)) for i in range(10)])
+    assert(history.size == 4)
+    window = history.window("soil_humidity", timedelta(hours=1), now=540)
+    assert(list(window) == [6, 7, 8, 9])
+    assert(history.mean("soil_humidity", timedelta(minutes=2), now=540) == 8)
+    assert(history.min("soil_humidity", timedelta(hours=1), now=540) == 6)
+    assert(history.max("soil_humidity", timedelta(hours=1), now=540) == 9)
+    assert(history.slope("soil_humidity", timedelta(hours=1),
+                         now=540) == pytest.approx(1))
+
+
+def test_sensor_history_rejects_older_readings():
+    history = make_history(4, [(60 * i, float(i)) for i in range(6)])
+    with pytest.raises(ValueError):
+        make_history(4, [(60, 1.0), (0, 2.0)])
+    history.append(300, {
+        "soil_humidity": 5.0,
+        "soil_temperature": 40,
+        "system_air_humidity": 60,
+        "system_air_temperature": 20,
+    })
+    assert(history.size == 4)
+
+
+def test_sensor_values_use_monotonic_clock(monkeypatch):
+    sensors = SensorValues("file")
+    line = "soil_hum: 50.0% soil_temp: 40.0ºC air_hum: 60.0% air_temp: 20.0ºC"
+    monkeypatch.setattr(manager.time, "monotonic", lambda: 100.0)
+    sensors.update_values(line)
+    # Readings are placed by the monotonic clock, not the wall clock
+    monkeypatch.setattr(manager.time, "monotonic", lambda: 103.0)
+    sensors.update_values(line)
+    assert(list(sensors.history.window(
+        "soil_humidity", timedelta(minutes=1), now=103.0)) == [50.0, 50.0])
+
+
+def test_sensor_history_stayed_below():
+    step = SENSOR_READING_INTERVAL.total_seconds()
+    history = make_history(
+        1000, [(step * i, SOIL_H2O_MIN - 1) for i in range(201)])
+    now = step * 200
+    assert(history.stayed_below("soil_humidity", SOIL_H2O_MIN,
+                                timedelta(minutes=10), now=now))
+    # History does not cover the whole window yet
+    assert(not history.stayed_below("soil_humidity", SOIL_H2O_MIN,
+                                    timedelta(minutes=20), now=now))
+    # Readings stopped a while ago
+    assert(not history.stayed_below("soil_humidity", SOIL_H2O_MIN,
+                                    timedelta(minutes=10), now=now + 60))
+    history.append(now + step, {
+        "soil_humidity": SOIL_H2O_MIN,
+        "soil_temperature": 40,
+        "system_air_humidity": 60,
+        "system_air_temperature": 20,
+    })
+    assert(not history.stayed_below("soil_humidity", SOIL_H2O_MIN,
+                                    timedelta(minutes=10), now=now + step))
+    assert(history.mean("soil_humidity", timedelta(minutes=10),
+                        now=10000) is None)
+
+
+def test_sensor_history_stayed_below_with_gap():
+    # The MCU went silent for 9 of the last 10 minutes
+    step = SENSOR_READING_INTERVAL.total_seconds()
+    readings = [(step * i, SOIL_H2O_MIN - 1) for i in range(100)]
+    readings += [(step * 99 + 540 + step * i, SOIL_H2O_MIN - 1)
+                 for i in range(20)]
+    history = make_history(1000, readings)
+    now = readings[-1][0]
+    assert(not history.stayed_below("soil_humidity", SOIL_H2O_MIN,
+                                    timedelta(minutes=10), now=now))
+    assert(history.stayed_below("soil_humidity", SOIL_H2O_MIN,
+                                timedelta(seconds=30), now=now))
+
+
+# "soil humidity too high", copied before test_state mutates it
+DRYING_CASE = copy.deepcopy(state_list[3])
+
+
+def drying_case():
+    return copy.deepcopy(DRYING_CASE)
+
+
+def test_state_changes_sent_in_one_frame():
+    # Blower, radiator and air renew valve switch together to dry the
+    # compost and must be sent in a single write.
+    case = drying_case()
+    ser = serial.Serial()
+    ser.write = MagicMock()
+    manager.current_time_is_at_night = MagicMock(return_value=False)
+    case.effectors.manage(ser, case.sensors)
+
+    ser.write.assert_called_once()
+    frame = ser.write.call_args[0][0]
+    assert(frame[:1] == BATCH_MSG_HEADER and frame[-1:] == BATCH_MSG_END)
+    assert(sorted(frame[1:-1]) == sorted(b"".join(case.expected_handshakes)))
+
+    manager.handle_msg("k" + frame[1:-1].decode(),
+                       case.sensors, case.effectors, ser)
+    assert(len(case.effectors.expected_handshakes) == 0)
+    assert(case.effectors.blower.curr_state == State.ON)
+    assert(case.effectors.radiator_valve.curr_state == State.ON)
+    assert(case.effectors.air_renew_valve.curr_state == State.ON)
+
+
+def test_single_byte_messages_fallback():
+    case = drying_case()
+    effectors = case.effectors
+    ser = serial.Serial()
+    ser.write = MagicMock()
+    manager.current_time_is_at_night = MagicMock(return_value=False)
+    switched = [effectors.blower, effectors.radiator_valve,
+                effectors.air_renew_valve]
+    for e in switched:
+        e.toggle_on()
+
+    # Batching is only abandoned after several frames in a row are lost
+    for i in range(manager.MAX_UNACKNOWLEDGED_FRAMES):
+        assert(effectors.batch_msgs)
+        effectors.update_states(ser, switched)
+        for handshake in effectors.expected_handshakes.values():
+            handshake.timestamp -= MAX_WAIT_HANDSHAKE
+        effectors.update_states(ser, switched)
+        assert(len(effectors.expected_handshakes) == 0)
+    assert(not effectors.batch_msgs)
+
+    ser.write.reset_mock()
+    effectors.update_states(ser, switched)
+    written = sorted(call[0][0] for call in ser.write.call_args_list)
+    assert(written == sorted(case.expected_handshakes))
+
+
+def test_batch_handshake_resets_lost_frames():
+    case = drying_case()
+    effectors = case.effectors
+    ser = serial.Serial()
+    ser.write = MagicMock()
+    effectors.blower.toggle_on()
+    effectors.radiator_valve.toggle_on()
+
+    effectors.update_states(ser, effectors.effectors)
+    for handshake in effectors.expected_handshakes.values():
+        handshake.timestamp -= MAX_WAIT_HANDSHAKE
+    effectors.update_states(ser, effectors.effectors)
+    assert(effectors.unacknowledged_frames == 1)
+
+    effectors.update_states(ser, effectors.effectors)
+    effectors.batch_handshake_received(BLOWER_ON_MSG + RADIATOR_ON_MSG)
+    assert(effectors.unacknowledged_frames == 0)
+    assert(effectors.batch_msgs)
+
+
+def test_turn_off_all_sends_single_messages():
+    case = drying_case()
+    ser = serial.Serial()
+    ser.write = MagicMock()
+    case.effectors.turn_off_all(ser)
+    written = sorted(call[0][0] for call in ser.write.call_args_list)
+    assert(written == sorted([BLOWER_OFF_MSG, WATER_PUMP_OFF_MSG,
+                              RADIATOR_OFF_MSG, AIR_RENEW_OFF_MSG]))
+
+
+def test_effector_usage_counters(tmp_path):
+    usage_file = str(tmp_path / "effector_usage.json")
+    history_file = str(tmp_path / "effector_usage_history.csv")
+    blower = Effector(name="blower", power_watts=60)
+    usage = manager.EffectorUsage([blower], usage_file, history_file)
+
+    on = datetime(2021, 6, 15, 23, 0, tzinfo=timezone.utc)
+    usage.switched_on(blower, on)
+    usage.switched_on(blower, on + timedelta(minutes=1))
+    assert(usage.usage(on + timedelta(minutes=30))["blower"] == {
+        "on_seconds": 1800, "switch_count": 1, "energy_wh": 30})
+
+    # On-time is split at midnight and the finished day goes to the history
+    usage.switched_off(blower, on + timedelta(hours=2))
+    assert(usage.day.isoformat() == "2021-06-16")
+    assert(usage.counters["blower"] == {
+        "on_seconds": 3600, "switch_count": 0, "energy_wh": 60})
+    with open(history_file) as f:
+        assert(f.read().splitlines() == [
+            "day,effector,on_seconds,switch_count,energy_wh",
+            "2021-06-15,blower,3600.0,1,60.0"])
+
+
+def test_effector_usage_survives_restart(tmp_path):
+    usage_file = str(tmp_path / "effector_usage.json")
+    blower = Effector(name="blower", power_watts=60)
+    on = datetime(2021, 6, 16, 10, 0, tzinfo=timezone.utc)
+    usage = manager.EffectorUsage([blower], usage_file)
+    usage.switched_on(blower, on)
+    usage.heartbeat(on + timedelta(seconds=30))
+    usage.heartbeat(on + manager.USAGE_HEARTBEAT_INTERVAL * 20)
+
+    # The manager stops ten hours later. The MCU resets on restart, so the
+    # blower was on only until the last heartbeat.
+    restored = manager.EffectorUsage([blower], usage_file)
+    restored.switched_off(blower, on + timedelta(hours=10))
+    assert(restored.counters["blower"] == {
+        "on_seconds": 1200, "switch_count": 1, "energy_wh": 20})
+
+    # Restarting again does not count the interval twice
+    restored = manager.EffectorUsage([blower], usage_file)
+    assert(restored.counters["blower"]["on_seconds"] == 1200)
+
+
+def test_effector_usage_history_rows_are_kept(tmp_path):
+    history_file = str(tmp_path / "effector_usage_history.csv")
+    writer = manager.LogWriter(maxsize=1)
+    writer.submit("file", ["a"], [1])
+    blower = Effector(name="blower", power_watts=60)
+    usage = manager.EffectorUsage([blower], history_file=history_file,
+                                  writer=writer)
+    on = datetime(2021, 6, 15, 23, 0, tzinfo=timezone.utc)
+    usage.switched_on(blower, on)
+    usage.switched_off(blower, on + timedelta(hours=2))
+
+    # The queue is full: the finished day is held back, not dropped
+    assert(writer.dropped == 0)
+    assert(writer._queue.get(timeout=1)[1] == "file")
+    writer.log_to_console()
+    record = writer._queue.get(timeout=1)
+    assert(record[:2] == (manager.RECORD_ROW, history_file))
+    assert(record[3] == ["2021-06-15", "blower", 3600.0, 1, 60.0])
+
+
+@pytest.mark.parametrize("content", ["", "{not json", "[]", '{"day": 3}'])
+def test_effector_usage_ignores_corrupt_file(tmp_path, content):
+    usage_file = tmp_path / "effector_usage.json"
+    usage_file.write_text(content)
+    usage = manager.EffectorUsage([Effector(name="blower")], str(usage_file))
+    assert(usage.counters == {})
+
+
+class FakeClock(datetime):
+    now_utc = datetime(2021, 6, 16, 10, 0, tzinfo=timezone.utc)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.now_utc
+
+
+def test_handshake_updates_usage(tmp_path, monkeypatch):
+    monkeypatch.setattr(manager, "datetime", FakeClock)
+    usage_file = str(tmp_path / "effector_usage.json")
+
+    def make_manager():
+        return EffectorManager(
+            water_pump=Effector(name="water pump",
+                                on_msg=WATER_PUMP_ON_MSG, off_msg=WATER_PUMP_OFF_MSG,
+                                power_watts=WATER_PUMP_POWER_W),
+            blower=Effector(name="blower",
+                            on_msg=BLOWER_ON_MSG, off_msg=BLOWER_OFF_MSG,
+                            power_watts=BLOWER_POWER_W),
+            radiator_valve=Effector(name="radiator valve",
+                                    on_msg=RADIATOR_ON_MSG, off_msg=RADIATOR_OFF_MSG),
+            air_renew_valve=Effector(name="air renewal valve",
+                                     on_msg=AIR_RENEW_ON_MSG, off_msg=AIR_RENEW_OFF_MSG),
+            usage_file=usage_file)
+
+    ser = serial.Serial()
+    ser.write = MagicMock()
+    effectors = make_manager()
+    effectors.blower.toggle_on()
+    effectors.update_state(ser, effectors.blower)
+    effectors.handshake_received(BLOWER_ON_MSG)
+
+    # The manager runs for ten more minutes, then restarts half an hour
+    # later with the blower on and turns everything off at startup
+    monkeypatch.setattr(FakeClock, "now_utc",
+                        FakeClock.now_utc + timedelta(minutes=10))
+    effectors.usage.heartbeat()
+    monkeypatch.setattr(FakeClock, "now_utc",
+                        FakeClock.now_utc + timedelta(minutes=30))
+    effectors = make_manager()
+    effectors.turn_off_all(ser)
+    for msg in [BLOWER_OFF_MSG, WATER_PUMP_OFF_MSG,
+                RADIATOR_OFF_MSG, AIR_RENEW_OFF_MSG]:
+        effectors.handshake_received(msg)
+
+    usage = effectors.usage.usage()
+    assert(usage["blower"] == {"on_seconds": 600, "switch_count": 1,
+                               "energy_wh": BLOWER_POWER_W / 6})
+    assert("water pump" not in usage)
+
+
+def test_persist_logs_survives_write_errors(tmp_path):
+    filename = str(tmp_path / "values.csv")
+    log_queue = manager.LOG_WRITER_CONTEXT.Queue()
+    log_queue.put((manager.RECORD_ROW,
+                   str(tmp_path / "missing" / "values.csv"), ["value"], [0]))
+    log_queue.put((manager.RECORD_ROW, filename, ["value"], [1]))
+    log_queue.put(None)
+
+    manager.persist_logs(log_queue)
+
+    with open(filename) as f:
+        assert(f.read().splitlines() == ["value", "1"])
+
+
+def test_log_writer_restarts_dead_process():
+    writer = manager.LogWriter()
+    writer._process = MagicMock()
+    writer._process.is_alive.return_value = False
+    writer.start = MagicMock()
+    # Queueing never restarts the process; only the main thread does
+    writer.submit("file", ["a"], [1])
+    writer.start.assert_not_called()
+    writer.supervise()
+    writer.start.assert_called_once()
+
+
+def test_log_writer_stop_writes_queued_rows(tmp_path):
+    filename = str(tmp_path / "values.csv")
+    writer = manager.LogWriter()
+    writer.start()
+    writer.submit(filename, ["value"], [1])
+    writer.stop()
+    assert(not writer.is_alive())
+    with open(filename) as f:
+        assert(f.read().splitlines() == ["value", "1"])
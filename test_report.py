@@ -0,0 +1,136 @@
+import pytest
+import numpy as np
+import report
+
+EFFECTOR_LOG = """timestamp_utc,air_blower,water_pump,radiator_valve,air_renew_valve\r
+2021-06-15T23:59:50+00:00,False,False,False,False\r
+2021-06-15T23:59:55+00:00,True,True,True,True\r
+2021-06-16T00:00:00+00:00,State.ON,State.OFF,State.ON,State.ON\r
+2021-06-16T00:00:05+00:00,False,State.ON,False,False\r
+2021-06-16T00:00:10+00:00,False,False,False,False\r
+2021-06-16T02:00:00+00:00,False,True,False,False\r
+2021-06-16T02:00:05+00:00,False,False,False,False\r
+"""
+
+SENSOR_LOG = """timestamp_utc,soil_humidity,soil_temperature,system_air_humidity,system_air_temperature\r
+2021-06-16T00:00:00+00:00,40.0,20.0,90.0,20.0\r
+2021-06-16T00:00:10+00:00,50.0,61.0,50.0,20.0\r
+2021-06-16T00:00:20+00:00,70.0,20.0,50.0,20.0\r
+2021-06-16T00:00:30+00:00,50.0,20.0,50.0,20.0\r
+"""
+
+
+@pytest.fixture
+def effector_log(tmp_path):
+    path = tmp_path / "effector_states.csv"
+    path.write_bytes(EFFECTOR_LOG.encode())
+    return str(path)
+
+
+def test_effector_report(effector_log):
+    totals = report.summarize_log(effector_log, "effectors")
+    first, second = np.datetime64("2021-06-15"), np.datetime64("2021-06-16")
+    assert(sorted(totals.days) == [first, second])
+
+    assert(totals.observed(first) == 10)
+    assert(totals.on_seconds(first, "air_blower") == 5)
+    assert(totals.rises(first, "water_pump") == 1)
+    assert(totals.rises(first, "drying") == 1)
+
+    # The two hour gap is not counted
+    assert(totals.observed(second) == 15)
+    assert(totals.on_seconds(second, "air_blower") == 5)
+    assert(totals.on_seconds(second, "water_pump") == 10)
+    assert(totals.rises(second, "water_pump") == 2)
+    assert(totals.rises(second, "drying") == 0)
+
+
+@pytest.mark.parametrize("jobs", [2, 3])
+def test_effector_report_in_parallel(effector_log, jobs, monkeypatch):
+    expected = report.summarize_log(effector_log, "effectors")
+    monkeypatch.setattr(report, "CHUNK_BYTES", 64)
+    totals = report.summarize_log(effector_log, "effectors", jobs)
+    assert(sorted(totals.days) == sorted(expected.days))
+    for day in expected.days:
+        assert(np.array_equal(totals.days[day], expected.days[day]))
+
+
+def test_sensor_report(tmp_path):
+    path = tmp_path / "sensor_values.csv"
+    path.write_bytes(SENSOR_LOG.encode())
+    totals = report.summarize_log(str(path), "sensors")
+    day = np.datetime64("2021-06-16")
+    assert(totals.observed(day) == 30)
+    assert(totals.on_seconds(day, "soil_humidity < SOIL_H2O_MIN") == 10)
+    assert(totals.on_seconds(day, "soil_humidity >= SOIL_H2O_MAX") == 10)
+    assert(totals.on_seconds(day, "soil_temperature >= SOIL_TEMP_MAX") == 10)
+    assert(totals.on_seconds(day, "system_air_humidity > AIR_H2O_MAX") == 10)
+
+
+def test_report_skips_malformed_lines(effector_log, tmp_path):
+    expected = report.summarize_log(effector_log, "effectors")
+    path = tmp_path / "truncated.csv"
+    lines = EFFECTOR_LOG.splitlines(keepends=True)
+    # A line cut short in the middle of the log and at its end
+    path.write_bytes("".join(
+        lines[:3] + ["2021-06-16T00:00:01+00:00,Tr\r\n",
+                     "2021-06-16T00:00:02+00:00,True,,True,True\r\n"] +
+        lines[3:] + ["2021-06-16T02:00:07+00:00,False,Fa"]).encode())
+    totals = report.summarize_log(str(path), "effectors")
+    for day in expected.days:
+        assert(np.array_equal(totals.days[day], expected.days[day]))
+
+
+@pytest.mark.parametrize("content", [b"", b"timestamp_utc,air_blower\r\n"])
+def test_report_on_empty_log(tmp_path, content):
+    path = tmp_path / "effector_states.csv"
+    path.write_bytes(content)
+    assert(report.summarize_log(str(path), "effectors", 2) is None)
+
+
+def write_effector_log(path, rows):
+    header = "timestamp_utc,air_blower,water_pump,radiator_valve,air_renew_valve"
+    path.write_text("\r\n".join([header] + [
+        f"{np.datetime64('2021-06-16T00:00:00') + np.timedelta64(i * 3, 's')}"
+        f"+00:00,{row}" for i, row in enumerate(rows)]) + "\r\n")
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_drying_cycles_ignore_flicker(tmp_path, jobs, monkeypatch):
+    drying = "True,False,True,True"
+    # The radiator drops out for a tick now and then, as the temperature
+    # check switches it off between drying ticks
+    flicker = "True,False,False,True"
+    idle = "False,False,False,True"
+    # 10 min off, 10 min on
+    cycle = ([idle] * 200 + [drying] * 50 + [flicker] + [drying] * 50 +
+             [flicker] + [drying] * 98)
+    path = tmp_path / "effector_states.csv"
+    write_effector_log(path, cycle * 3)
+    monkeypatch.setattr(report, "CHUNK_BYTES", 4096)
+
+    totals = report.summarize_log(str(path), "effectors", jobs)
+    day = np.datetime64("2021-06-16")
+    assert(totals.rises(day, "drying") == 3)
+    assert(totals.rises(day, "radiator_valve") == 9)
+
+
+def test_report_skips_corrupt_values(tmp_path):
+    path = tmp_path / "sensor_values.csv"
+    lines = SENSOR_LOG.splitlines(keepends=True)
+    path.write_bytes("".join(
+        lines[:2] + ["2021-06-16T00:00:05+00:00,4\x000.0,20.0,None,20.0\r\n",
+                     "2021-06-16T00:0\x00:07+00:00,40.0,20.0,90.0,20.0\r\n"] +
+        lines[2:]).encode())
+    totals = report.summarize_log(str(path), "sensors")
+    day = np.datetime64("2021-06-16")
+    assert(totals.observed(day) == 30)
+    assert(totals.on_seconds(day, "soil_humidity < SOIL_H2O_MIN") == 10)
+
+    path = tmp_path / "effector_states.csv"
+    lines = EFFECTOR_LOG.splitlines(keepends=True)
+    path.write_bytes("".join(
+        lines[:3] + ["2021-06-16T00:00:01+00:00,Tr\x00e,True,True,True\r\n"] +
+        lines[3:]).encode())
+    totals = report.summarize_log(str(path), "effectors")
+    assert(totals.on_seconds(day, "water_pump") == 10)